@@ -2,10 +2,14 @@
 """Fetch latest videos from configured YouTube channels and save to data/videos.json."""
 
 import os
-import re
-import json
-import requests
-from datetime import datetime, timezone
+import time
+import random
+import asyncio
+import argparse
+import httpx
+import orjson
+from functools import lru_cache
+from diskcache import Cache
 
 API_KEY = os.environ.get('YOUTUBE_API_KEY')
 if not API_KEY:
@@ -14,31 +18,84 @@ if not API_KEY:
 BASE = 'https://www.googleapis.com/youtube/v3'
 CHANNELS_FILE = 'channels.txt'
 OUTPUT_FILE = 'data/videos.json'
+CACHE_DIR = '.cache/yt'
 MAX_VIDEOS = 50           # target number of non-Short videos per channel
 MAX_PAGES = 4             # fetch at most this many pages (50 videos each) per channel
 SHORTS_MAX_SECONDS = 180  # videos <= 3 min are treated as Shorts and excluded
+DURATION_UNITS = {'H': 3600, 'M': 60, 'S': 1}
+MAX_IN_FLIGHT = 10        # concurrent API requests across all channels (the only limit)
+MAX_ATTEMPTS = 5          # tries per API call before giving up
+MAX_RETRY_DELAY = 30      # seconds; cap on backoff and on Retry-After
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+REQUEST_TIMEOUT = 10      # seconds per API call
+CHANNEL_TTL = 30 * 86400  # handle → channel details rarely change
+PLAYLIST_TTL = 3 * 3600   # uploads list is re-fetched after 3 hours
+# Stored bodies for ETag revalidation outlive the results cached from them.
+CHANNEL_ETAG_TTL = 2 * CHANNEL_TTL
+PLAYLIST_ETAG_TTL = 3 * 86400
 
+# Partial responses: only the fields this script reads. etag and nextPageToken
+# are kept for revalidation and paging.
+CHANNEL_FIELDS = 'etag,items(id,snippet(title,thumbnails/default/url))'
+PLAYLIST_FIELDS = ('etag,nextPageToken,items/snippet(title,publishedAt,resourceId/videoId,'
+                   'thumbnails(medium/url,high/url,default/url))')
+VIDEO_FIELDS = 'items(id,contentDetails/duration)'
 
-def yt(endpoint, **params):
+cache = Cache(CACHE_DIR)
+resolved_channels = {}  # identifier → task resolving its UC channel ID, for this process only
+in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+
+async def yt(client, endpoint, etag=None, **params):
+    """Call the API. Returns None if `etag` is given and the resource is unchanged.
+
+    Rate-limit and server errors, timeouts and dropped connections are
+    retried with jittered exponential backoff.
+    """
     params['key'] = API_KEY
-    r = requests.get(f'{BASE}/{endpoint}', params=params)
+    headers = {'If-None-Match': etag} if etag else None
+    for attempt in range(MAX_ATTEMPTS):
+        last_attempt = attempt == MAX_ATTEMPTS - 1
+        try:
+            async with in_flight:
+                r = await client.get(f'{BASE}/{endpoint}', params=params, headers=headers)
+        except httpx.TransportError as e:  # includes timeouts
+            if last_attempt:
+                raise
+            reason, retry_after = type(e).__name__, ''
+        else:
+            if r.status_code not in RETRY_STATUSES or last_attempt:
+                break
+            reason, retry_after = f'HTTP {r.status_code}', r.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            delay = min(int(retry_after), MAX_RETRY_DELAY)
+        else:
+            delay = min(2 ** attempt + random.random(), MAX_RETRY_DELAY)
+        print(f"  {endpoint}: {reason}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    if r.status_code == 304:
+        return None
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
 
 
-def resolve_channel(identifier):
-    if identifier.startswith('@'):
-        data = yt('channels', part='id,snippet,contentDetails', forHandle=identifier)
-    elif identifier.startswith('UC'):
-        data = yt('channels', part='id,snippet,contentDetails', id=identifier)
-    else:
-        data = yt('channels', part='id,snippet,contentDetails', forUsername=identifier)
+async def yt_revalidated(client, endpoint, expire, **params):
+    """Call yt(), sending the ETag of the last response so unchanged bodies aren't re-sent.
 
-    if not data.get('items'):
-        print(f"  WARNING: Channel not found: {identifier}")
-        return None
+    Stored responses are dropped after `expire` seconds so stale ones don't pile up.
+    """
+    key = ('etag', endpoint, tuple(sorted(params.items())))
+    stored = cache.get(key)
+    data = await yt(client, endpoint, etag=stored and stored['etag'], **params)
+    if data is None:
+        return stored['body']
+    if data.get('etag'):
+        cache.set(key, {'etag': data['etag'], 'body': data}, expire=expire)
+    return data
 
-    item = data['items'][0]
+
+def channel_info(item):
     thumbs = item['snippet']['thumbnails']
     thumb = thumbs.get('default', {}).get('url', '')
 
@@ -46,41 +103,142 @@ def resolve_channel(identifier):
         'id': item['id'],
         'name': item['snippet']['title'],
         'thumbnail': thumb,
-        'uploads_playlist': item['contentDetails']['relatedPlaylists']['uploads'],
     }
 
 
+def uploads_playlist(channel_id):
+    """A channel's uploads playlist ID is its UC... ID with the prefix swapped for UU."""
+    return 'UU' + channel_id[2:]
+
+
+async def resolve_channel(client, identifier):
+    """Resolve a @handle or legacy username to its UC channel ID.
+
+    The lookup task is memoized in-process on top of the disk cache, so a
+    handle listed twice is looked up once even when both resolve concurrently.
+    """
+    if identifier not in resolved_channels:
+        resolved_channels[identifier] = asyncio.ensure_future(fetch_channel_id(client, identifier))
+    return await resolved_channels[identifier]
+
+
+async def fetch_channel_id(client, identifier):
+    """Look up a handle or username (the API takes only one per call).
+
+    The handle → ID mapping is cached for good, so later runs resolve the
+    channel like a UC ID; its name and thumbnail are cached as usual.
+    """
+    key = ('handle', identifier)
+    channel_id = cache.get(key)
+    if channel_id is not None:
+        return channel_id
+
+    if identifier.startswith('@'):
+        data = await yt_revalidated(client, 'channels', CHANNEL_ETAG_TTL, part='id,snippet',
+                                    fields=CHANNEL_FIELDS, forHandle=identifier)
+    else:
+        data = await yt_revalidated(client, 'channels', CHANNEL_ETAG_TTL, part='id,snippet',
+                                    fields=CHANNEL_FIELDS, forUsername=identifier)
+
+    if not data.get('items'):
+        print(f"  WARNING: Channel not found: {identifier}")
+        return None
+
+    channel = channel_info(data['items'][0])
+    cache.set(key, channel['id'])
+    cache.set(('channel', channel['id']), channel, expire=CHANNEL_TTL)
+    return channel['id']
+
+
+async def resolve_channel_ids(client, channel_ids):
+    """Look up names and thumbnails for UC channel IDs, batched 50 per channels.list call."""
+    channels = {}
+    missing = []
+    for cid in channel_ids:
+        channel = cache.get(('channel', cid))
+        if channel is None:
+            missing.append(cid)
+        else:
+            channels[cid] = channel
+
+    for i in range(0, len(missing), 50):
+        batch = missing[i:i + 50]
+        data = await yt_revalidated(client, 'channels', CHANNEL_ETAG_TTL, part='id,snippet',
+                                    fields=CHANNEL_FIELDS, id=','.join(batch))
+        for item in data.get('items', []):
+            channel = channel_info(item)
+            channels[item['id']] = channel
+            cache.set(('channel', item['id']), channel, expire=CHANNEL_TTL)
+    return channels
+
+
+@lru_cache(maxsize=4096)
 def parse_duration(iso):
-    """Convert ISO 8601 duration (e.g. PT4M13S) to total seconds."""
-    m = re.fullmatch(r'PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?', iso or '')
-    if not m:
+    """Convert ISO 8601 duration (e.g. PT4M13S) to total seconds.
+
+    Hand-rolled scanner for the PT#H#M#S form the API uses; anything else
+    (e.g. P1DT2H, or P0D for upcoming premieres) counts as 0.
+    """
+    if not iso or not iso.startswith('PT'):
         return 0
-    h, mins, s = (int(x or 0) for x in m.groups())
-    return h * 3600 + mins * 60 + s
+    total = 0
+    value = None
+    units = 'HMS'  # remaining units, in the order they may appear
+    for c in iso[2:]:
+        if '0' <= c <= '9':
+            value = (value or 0) * 10 + ord(c) - 48
+            continue
+        pos = units.find(c)
+        if pos < 0 or value is None:
+            return 0
+        total += value * DURATION_UNITS[c]
+        value = None
+        units = units[pos + 1:]
+    return 0 if value is not None else total
+
+
+async def get_durations(client, video_ids):
+    """Fetch durations for a list of video IDs, batched 50 at a time.
 
+    Durations never change, so cached ones are kept forever and only
+    videos not seen before are sent to videos.list. A 0 (P0D: an upcoming
+    premiere or live stream) is not cached, since it changes once the stream ends.
+    """
+    cached = {vid: cache.get(('duration', vid)) for vid in video_ids}
+    durations = {vid: dur for vid, dur in cached.items() if dur is not None}
+    missing = [vid for vid, dur in cached.items() if dur is None]
 
-def get_durations(video_ids):
-    """Fetch durations for a list of video IDs, batched 50 at a time."""
-    durations = {}
-    for i in range(0, len(video_ids), 50):
-        batch = video_ids[i:i + 50]
-        data = yt('videos', part='contentDetails', id=','.join(batch))
+    for i in range(0, len(missing), 50):
+        batch = missing[i:i + 50]
+        try:
+            data = await yt(client, 'videos', part='contentDetails', fields=VIDEO_FIELDS, id=','.join(batch))
+        except Exception as e:
+            # Leave these IDs out; filter_shorts() keeps videos of unknown length.
+            print(f"  ERROR fetching durations for {len(batch)} videos: {e}")
+            continue
         for item in data.get('items', []):
-            durations[item['id']] = parse_duration(
-                item['contentDetails']['duration']
-            )
+            duration = parse_duration(item['contentDetails']['duration'])
+            durations[item['id']] = duration
+            if duration:
+                cache.set(('duration', item['id']), duration)
     return durations
 
 
-def fetch_videos(playlist_id):
+async def fetch_videos(client, playlist_id):
+    """Fetch recent uploads, unfiltered; Shorts are dropped later by filter_shorts()."""
+    key = ('playlist', playlist_id)
+    videos = cache.get(key)
+    if videos is not None:
+        return videos
+
     raw = []
     page_token = None
 
     for _ in range(MAX_PAGES):
-        params = dict(part='snippet', playlistId=playlist_id, maxResults=50)
+        params = dict(part='snippet', playlistId=playlist_id, maxResults=50, fields=PLAYLIST_FIELDS)
         if page_token:
             params['pageToken'] = page_token
-        data = yt('playlistItems', **params)
+        data = await yt_revalidated(client, 'playlistItems', PLAYLIST_ETAG_TTL, **params)
 
         for item in data.get('items', []):
             snippet = item['snippet']
@@ -103,10 +261,13 @@ def fetch_videos(playlist_id):
         if not page_token:
             break
 
-    # Filter out Shorts (videos <= 3 minutes)
-    durations = get_durations([v['id'] for v in raw])
-    videos = [v for v in raw if durations.get(v['id'], 9999) > SHORTS_MAX_SECONDS]
+    cache.set(key, raw, expire=PLAYLIST_TTL)
+    return raw
+
 
+def filter_shorts(videos, durations):
+    """Drop Shorts (videos <= 3 minutes) and keep the first MAX_VIDEOS."""
+    videos = [v for v in videos if durations.get(v['id'], 9999) > SHORTS_MAX_SECONDS]
     return videos[:MAX_VIDEOS]
 
 
@@ -122,41 +283,113 @@ def read_identifiers():
         raise SystemExit(f"ERROR: {CHANNELS_FILE} not found.")
 
 
-def main():
+async def identify(client, ident):
+    """Map a channels.txt entry to its UC channel ID; UC IDs need no API call."""
+    if ident.startswith('UC'):
+        return ident, ident
+    try:
+        return ident, await resolve_channel(client, ident)
+    except Exception as e:
+        print(f"  ERROR resolving {ident}: {e}")
+        return ident, None
+
+
+async def process(client, ident, channel_id, details):
+    """Fetch a channel's uploads while `details` (id → name/thumbnail) is still pending."""
+    print(f"Processing: {ident}")
+    uploads = asyncio.create_task(fetch_videos(client, uploads_playlist(channel_id)))
+    try:
+        channel = (await details).get(channel_id)
+    except Exception as e:
+        # Only the name/thumbnail lookup failed: keep the uploads, under a
+        # stand-in name unless this channel's details were already cached.
+        channel = cache.get(('channel', channel_id))
+        if not channel:
+            print(f"  ERROR looking up details for {ident}: {e}")
+            channel = {'id': channel_id, 'name': ident, 'thumbnail': ''}
+    try:
+        videos = await uploads
+    except Exception as e:
+        print(f"  ERROR processing {ident}: {e}")
+        return None
+    if not channel:
+        print(f"  WARNING: Channel not found: {ident}")
+        return None
+    return {
+        'id': channel['id'],
+        'name': channel['name'],
+        'thumbnail': channel['thumbnail'],
+        'videos': videos,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'clear the API response cache in {CACHE_DIR} before fetching')
+    args = parser.parse_args()
+    if args.no_cache:
+        cache.clear()
+
     identifiers = read_identifiers()
     if not identifiers:
         print("No channels configured. Add channels to channels.txt.")
         return
 
-    channels_data = []
-    for ident in identifiers:
-        print(f"Processing: {ident}")
+    # All channels run concurrently; results come back in channels.txt order.
+    # One HTTP/2 client multiplexes every API call over a few pooled connections.
+    # Concurrency is set by the in_flight semaphore; the pool cap just matches it.
+    async with httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=MAX_IN_FLIGHT),
+        headers={'Accept-Encoding': 'gzip, br'},
+        timeout=REQUEST_TIMEOUT,
+    ) as client:
+        # Pipeline the stages: a channel's uploads are requested as soon as its
+        # ID is known (immediately for UC IDs), while handles are still resolving.
+        details = asyncio.get_running_loop().create_future()
+        channel_ids = {}
+        fetching = {}
+        for identified in asyncio.as_completed([identify(client, ident) for ident in identifiers]):
+            ident, channel_id = await identified
+            if channel_id:
+                channel_ids[ident] = channel_id
+                fetching[ident] = asyncio.create_task(process(client, ident, channel_id, details))
+
+        # Names and thumbnails come from the cache, or one channels.list call per 50 IDs.
+        unique_ids = list(dict.fromkeys(channel_ids.values()))
         try:
-            channel = resolve_channel(ident)
-            if not channel:
-                continue
-            videos = fetch_videos(channel['uploads_playlist'])
-            channels_data.append({
-                'id': channel['id'],
-                'name': channel['name'],
-                'thumbnail': channel['thumbnail'],
-                'videos': videos,
-            })
-            print(f"  → {channel['name']}: {len(videos)} videos")
+            details.set_result(await resolve_channel_ids(client, unique_ids))
         except Exception as e:
-            print(f"  ERROR processing {ident}: {e}")
+            details.set_exception(e)  # reported by each waiting process()
+        results = await asyncio.gather(
+            *(fetching[ident] for ident in identifiers if ident in fetching)
+        )
+        channels_data = [c for c in results if c]
+
+        # One videos.list pass for all channels, so small channels share calls.
+        all_ids = [v['id'] for ch in channels_data for v in ch['videos']]
+        durations = await get_durations(client, all_ids)
+
+    for ch in channels_data:
+        ch['videos'] = filter_shorts(ch['videos'], durations)
+        print(f"  → {ch['name']}: {len(ch['videos'])} videos")
 
     output = {
-        'last_updated': datetime.now(timezone.utc).isoformat(),
+        'last_updated': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
         'channels': channels_data,
     }
 
+    # Write to a temp file and swap it in, so readers never see a partial file.
+    buf = orjson.dumps(output, option=orjson.OPT_INDENT_2)
+    tmp = OUTPUT_FILE + '.tmp'
     os.makedirs('data', exist_ok=True)
-    with open(OUTPUT_FILE, 'w') as f:
-        json.dump(output, f, indent=2)
+    with open(tmp, 'wb') as f:
+        f.write(buf)
+    os.replace(tmp, OUTPUT_FILE)
 
     print(f"\nDone. Saved {len(channels_data)} channels to {OUTPUT_FILE}")
 
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())